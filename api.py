@@ -1,34 +1,149 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Request, Response, request, jsonify
+# Imported under another name: the /api/sendFile view below is called send_file
+from flask import send_file as flask_send_file
+from flask.json.provider import JSONProvider
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import select, update, delete, case, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import raiseload
+from sqlalchemy.pool import QueuePool
+from cachetools import TTLCache
 from datetime import datetime, timedelta, timezone
 import secrets
 import os
+import tempfile
 import sqlite3
 from werkzeug.utils import secure_filename
 from functools import wraps
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import threading
 import time
+import atexit
+import logging
+import logging.handlers
+import queue
 import math
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+import orjson
+import redis
+
+try:
+    import fcntl
+except ImportError:  # Windows: no flock, a single process is assumed
+    fcntl = None
+
+# Log records are queued and written by a listener thread, so request
+# threads never contend on the stdout lock
+log_queue = queue.Queue(-1)
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(message)s',
+    handlers=[logging.handlers.QueueHandler(log_queue)]
+)
+logger = logging.getLogger(__name__)
+
+ORJSON_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z
+
+# orjson serializes datetime natively, so models hand raw datetimes to jsonify
+class OrjsonProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=ORJSON_OPTIONS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, option=ORJSON_OPTIONS),
+            mimetype='application/json'
+        )
+
+# Spool multipart file parts straight into UPLOAD_FOLDER, so sendFile can
+# hard-link the finished upload into place instead of copying it from /tmp
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.NamedTemporaryFile('wb+', dir=UPLOAD_FOLDER, prefix=UPLOAD_SPOOL_PREFIX)
 
 # Initialize Flask app
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+app.request_class = UploadRequest
 app.config['SECRET_KEY'] = 'telegram-exact-api-2024'
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///telegram_exact.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['MAX_CONTENT_LENGTH'] = 30 * 1024 * 1024
+# Let a fronting Apache/lighttpd stream downloads via X-Sendfile
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'poolclass': QueuePool,
+    'pool_size': 10,
+    'max_overflow': 20,
+    'connect_args': {'check_same_thread': False}
+}
 
 # Initialize database
 db = SQLAlchemy(app)
 
+# WAL lets getUpdates readers run alongside the single writer
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA mmap_size=268435456')
+    cursor.execute('PRAGMA cache_size=-64000')
+    cursor.close()
+
 # Configuration
 UPLOAD_FOLDER = 'telegram_files'
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_SPOOL_PREFIX = '.upload-'
+STALE_UPLOAD_AGE = 3600
+DOWNLOAD_MAX_AGE = 3600
+MAX_FILE_SIZE = 30 * 1024 * 1024
 MAX_USER_STORAGE = 100 * 1024 * 1024
 MAX_TOTAL_STORAGE = 700 * 1024 * 1024
 MESSAGE_AUTO_DELETE_HOURS = 24
 POLLING_LIMIT = 50
+MAX_QUERY_LIMIT = 100
+MAX_POLL_TIMEOUT = 50
+MAX_ROW_ID = 2 ** 63 - 1
+ALLOWED_EXTENSIONS = frozenset({
+    'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'doc', 'docx',
+    'zip', 'mp3', 'mp4', 'tgs', 'webp', 'json', 'svg', 'avi',
+    'mov', 'wav', 'ogg', 'rar', '7z', 'ppt', 'pptx', 'xls', 'xlsx'
+})
+LONG_POLL_RECHECK = 5
+API_KEY_CACHE_SIZE = 10_000
+API_KEY_CACHE_TTL = 60
+ACTIVITY_FLUSH_INTERVAL = 30
+RATE_LIMIT_WINDOW = 60
+RATE_LIMIT_PER_WINDOW = int(os.environ.get('RATE_LIMIT_PER_WINDOW', 600))
+CLEANUP_INTERVAL = 300
+WEBHOOK_WORKERS = 16
+FILE_REMOVAL_WORKERS = 8
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+CLEANUP_LOCK_FILE = os.path.join(UPLOAD_FOLDER, '.cleanup.lock')
+
+# nginx internal location serving UPLOAD_FOLDER, e.g. /protected
+X_ACCEL_REDIRECT_PREFIX = os.environ.get('X_ACCEL_REDIRECT_PREFIX')
+
+# Optional Redis shared by all workers for the auth cache, activity buffer
+# and rate limits; without it each process keeps its own in-memory copies
+REDIS_URL = os.environ.get('REDIS_URL')
 
 # Get port from environment variable (Render provides this)
 PORT = int(os.environ.get('PORT', 3000))
@@ -62,10 +177,17 @@ class User(db.Model):
             'api_key': self.api_key,
             'storage_used': self.storage_used,
             'message_count': self.message_count,
-            'created_at': self.created_at.isoformat()
+            'created_at': self.created_at
         }
 
 class Message(db.Model):
+    __table_args__ = (
+        db.Index('ix_msg_receiver_id', 'receiver_id', 'id'),
+        db.Index('ix_msg_sent_at', 'sent_at'),
+        db.Index('ix_msg_file_id', 'file_id'),
+        db.Index('ix_msg_chat_pair_id', 'sender_id', 'receiver_id', 'id'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     message_id = db.Column(db.String(64), unique=True, nullable=False)
     message_type = db.Column(db.String(20), nullable=False)
@@ -101,34 +223,51 @@ class Message(db.Model):
             'sender_id': self.sender_id,
             'sender_username': self.sender_username,
             'receiver_id': self.receiver_id,
-            'sent_at': self.sent_at.isoformat(),
-            'expires_at': self.expires_at.isoformat(),
+            'sent_at': self.sent_at,
+            'expires_at': self.expires_at,
             'is_delivered': self.is_delivered,
             'read_count': self.read_count
         }
         
-        if self.message_type in ['text', 'reply']:
-            message_data['text'] = self.text_content
-        
-        if self.message_type == 'file':
-            message_data['file'] = {
-                'file_id': self.file_id,
-                'original_name': self.original_name,
-                'file_size': self.file_size,
-                'mime_type': self.mime_type
-            }
-            if self.text_content:
-                message_data['caption'] = self.text_content
-        
-        if self.message_type == 'reply' and self.reply_to_message_id:
-            message_data['reply_to'] = {
-                'message_id': self.reply_to_message_id,
-                'sender_id': self.reply_to_sender_id,
-                'text_preview': self.reply_to_text[:100] + '...' if self.reply_to_text and len(self.reply_to_text) > 100 else self.reply_to_text
-            }
+        add_fields = MESSAGE_FIELD_BUILDERS.get(self.message_type)
+        if add_fields:
+            add_fields(self, message_data)
         
         return message_data
 
+# Type-specific to_dict() fields, dispatched on Message.message_type
+def add_text_fields(message, message_data):
+    message_data['text'] = message.text_content
+
+def add_file_fields(message, message_data):
+    message_data['file'] = {
+        'file_id': message.file_id,
+        'original_name': message.original_name,
+        'file_size': message.file_size,
+        'mime_type': message.mime_type
+    }
+    if message.text_content:
+        message_data['caption'] = message.text_content
+
+def add_reply_fields(message, message_data):
+    message_data['text'] = message.text_content
+    
+    preview = message.reply_to_text
+    if preview and len(preview) > 100:
+        preview = preview[:100] + '...'
+    
+    message_data['reply_to'] = {
+        'message_id': message.reply_to_message_id,
+        'sender_id': message.reply_to_sender_id,
+        'text_preview': preview
+    }
+
+MESSAGE_FIELD_BUILDERS = {
+    'text': add_text_fields,
+    'file': add_file_fields,
+    'reply': add_reply_fields
+}
+
 class UserWebhook(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.String(80), nullable=False)
@@ -138,6 +277,112 @@ class UserWebhook(db.Model):
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
     last_triggered = db.Column(db.DateTime)
 
+class GlobalStats(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    total_storage = db.Column(db.BigInteger, default=0)
+
+# Authentication cache: api_key -> User.id, so repeat requests resolve the
+# user by primary key. last_activity is buffered (in Redis when configured)
+# and flushed in bulk by the background thread instead of per request.
+redis_client = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+api_key_cache = TTLCache(maxsize=API_KEY_CACHE_SIZE, ttl=API_KEY_CACHE_TTL)
+api_key_cache_lock = threading.Lock()
+pending_activity = {}
+pending_activity_lock = threading.Lock()
+rate_limit_counts = TTLCache(maxsize=API_KEY_CACHE_SIZE, ttl=RATE_LIMIT_WINDOW)
+rate_limit_lock = threading.Lock()
+
+# Redis errors fall back to the in-process structures below, so an outage
+# costs cross-worker sharing rather than failing authenticated requests
+def get_cached_user_pk(api_key):
+    if redis_client:
+        try:
+            user_pk = redis_client.get(f'apikey:{api_key}')
+            return int(user_pk) if user_pk is not None else None
+        except redis.RedisError as e:
+            logger.warning("Redis auth cache unavailable: %s", e)
+    with api_key_cache_lock:
+        return api_key_cache.get(api_key)
+
+def cache_user_pk(api_key, user_pk):
+    if redis_client:
+        try:
+            redis_client.set(f'apikey:{api_key}', user_pk, ex=API_KEY_CACHE_TTL)
+            return
+        except redis.RedisError as e:
+            logger.warning("Redis auth cache unavailable: %s", e)
+    with api_key_cache_lock:
+        api_key_cache[api_key] = user_pk
+
+def record_activity(user_pk):
+    now = datetime.now(timezone.utc)
+    if redis_client:
+        try:
+            redis_client.zadd('activity', {user_pk: now.timestamp()})
+            return
+        except redis.RedisError as e:
+            logger.warning("Redis activity buffer unavailable: %s", e)
+    with pending_activity_lock:
+        pending_activity[user_pk] = now
+
+def take_pending_activity():
+    # The local buffer is drained even with Redis, since it holds whatever
+    # was recorded while Redis was unreachable
+    with pending_activity_lock:
+        activity = dict(pending_activity)
+        pending_activity.clear()
+    if redis_client:
+        try:
+            pipe = redis_client.pipeline()
+            pipe.zrange('activity', 0, -1, withscores=True)
+            pipe.delete('activity')
+            entries, _ = pipe.execute()
+        except redis.RedisError as e:
+            logger.warning("Redis activity buffer unavailable: %s", e)
+            return activity
+        for user_pk, timestamp in entries:
+            user_pk = int(user_pk)
+            last_activity = datetime.fromtimestamp(timestamp, timezone.utc)
+            if user_pk not in activity or activity[user_pk] < last_activity:
+                activity[user_pk] = last_activity
+    return activity
+
+def restore_pending_activity(activity):
+    # Put back a batch that failed to flush without overwriting newer entries
+    if redis_client:
+        try:
+            redis_client.zadd(
+                'activity',
+                {user_pk: last_activity.timestamp() for user_pk, last_activity in activity.items()},
+                gt=True
+            )
+            return
+        except redis.RedisError as e:
+            logger.warning("Redis activity buffer unavailable: %s", e)
+    with pending_activity_lock:
+        for user_pk, last_activity in activity.items():
+            pending_activity.setdefault(user_pk, last_activity)
+
+def is_rate_limited(user_pk):
+    # Keyed by the resolved user, so unknown keys can't reset real counters
+    if not RATE_LIMIT_PER_WINDOW:
+        return False
+    
+    key = f'ratelimit:{user_pk}:{int(time.time() // RATE_LIMIT_WINDOW)}'
+    if redis_client:
+        try:
+            pipe = redis_client.pipeline()
+            pipe.incr(key)
+            pipe.expire(key, RATE_LIMIT_WINDOW)
+            count, _ = pipe.execute()
+            return count > RATE_LIMIT_PER_WINDOW
+        except redis.RedisError as e:
+            logger.warning("Redis rate limiter unavailable: %s", e)
+    with rate_limit_lock:
+        count = rate_limit_counts.get(key, 0) + 1
+        rate_limit_counts[key] = count
+    return count > RATE_LIMIT_PER_WINDOW
+
 # Authentication Middleware
 def require_api_key(f):
     @wraps(f)
@@ -150,72 +395,181 @@ def require_api_key(f):
                 'error': 'API Key required'
             }), 401
         
-        user = User.query.filter_by(api_key=api_key, is_active=True).first()
-        if not user:
+        user_pk = get_cached_user_pk(api_key)
+        
+        if user_pk is not None:
+            user = db.session.get(User, user_pk)
+        else:
+            user = User.query.filter_by(api_key=api_key, is_active=True).first()
+            if user:
+                cache_user_pk(api_key, user.id)
+        
+        if not user or not user.is_active:
             return jsonify({
                 'success': False,
                 'error': 'Invalid API Key'
             }), 401
         
-        user.last_activity = datetime.now(timezone.utc)
-        db.session.commit()
+        if is_rate_limited(user.id):
+            return jsonify({
+                'success': False,
+                'error': 'Rate limit exceeded'
+            }), 429
+        
+        record_activity(user.id)
         
         request.user = user
         return f(*args, **kwargs)
     return decorated_function
 
+# Long-poll wakeups: getUpdates waits on the receiver's inbox condition and
+# senders notify it after commit. Waits are capped at LONG_POLL_RECHECK so
+# messages written by another worker process are still picked up.
+inboxes = defaultdict(threading.Condition)
+inboxes_lock = threading.Lock()
+
+def get_inbox(user_id):
+    with inboxes_lock:
+        return inboxes[user_id]
+
+def notify_inbox(user_id):
+    inbox = get_inbox(user_id)
+    with inbox:
+        inbox.notify_all()
+
 # Helper Functions
 def allowed_file(filename):
-    ALLOWED_EXTENSIONS = {
-        'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'doc', 'docx', 
-        'zip', 'mp3', 'mp4', 'tgs', 'webp', 'json', 'svg', 'avi', 
-        'mov', 'wav', 'ogg', 'rar', '7z', 'ppt', 'pptx', 'xls', 'xlsx'
-    }
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    _, dot, extension = filename.rpartition('.')
+    return bool(dot) and extension.lower() in ALLOWED_EXTENSIONS
+
+def int_arg(name, default, low, high):
+    # Parse and clamp a query-string integer without raising on bad input
+    value = request.args.get(name)
+    if value is None:
+        return default
+    value = value.strip()
+    digits = value[1:] if value[:1] in ('-', '+') else value
+    if not (digits.isascii() and digits.isdigit()):
+        return default
+    # Past 19 digits the value is beyond MAX_ROW_ID either way; clamp it
+    # without handing int() a string of unbounded length
+    if len(digits) > 19:
+        return low if value[0] == '-' else high
+    return max(low, min(high, int(value)))
+
+def generate_ids(count):
+    # 128-bit hex IDs cut from a single os.urandom draw
+    buf = os.urandom(16 * count)
+    return [buf[i:i + 16].hex() for i in range(0, len(buf), 16)]
+
+def save_upload(file, file_path, max_size):
+    # Uploads spooled by UploadRequest are already on disk next to their
+    # destination: size them with fstat and link them in without a copy
+    stream = file.stream
+    spool_path = getattr(stream, 'name', None)
+    if isinstance(spool_path, str) and os.path.dirname(spool_path) == os.path.abspath(UPLOAD_FOLDER):
+        stream.flush()
+        file_size = os.fstat(stream.fileno()).st_size
+        if file_size > max_size:
+            return file_size
+        try:
+            os.link(spool_path, file_path)
+            # Temp files are created 0600; keep uploads readable by a
+            # fronting web server serving X-Sendfile/X-Accel-Redirect
+            os.chmod(file_path, 0o644)
+            return file_size
+        except OSError:
+            stream.seek(0)
+    
+    # Otherwise copy in one pass, counting bytes as they are written, and
+    # stop as soon as the upload grows past max_size
+    file_size = 0
+    with open(file_path, 'wb', buffering=UPLOAD_CHUNK_SIZE) as out:
+        while chunk := stream.read(UPLOAD_CHUNK_SIZE):
+            file_size += len(chunk)
+            if file_size > max_size:
+                break
+            out.write(chunk)
+    
+    if file_size > max_size:
+        os.remove(file_path)
+    return file_size
 
+# Running SUM(Message.file_size), kept in GlobalStats by the same transactions
+# that add or delete files so reads never scan the messages table
 def get_total_storage_used():
-    total = db.session.query(db.func.sum(Message.file_size)).filter(Message.file_size.isnot(None)).scalar()
+    total = db.session.query(GlobalStats.total_storage).scalar()
     return total or 0
 
-def send_webhook_notification(user_id, message_data):
-    try:
-        webhook = UserWebhook.query.filter_by(user_id=user_id, is_active=True).first()
-        if not webhook:
-            return False
-        
-        payload = {
-            'event': 'new_message',
-            'timestamp': datetime.now(timezone.utc).isoformat(),
-            'data': message_data
-        }
-        
-        headers = {
-            'Content-Type': 'application/json',
-            'User-Agent': 'TelegramBot/1.0'
-        }
-        
-        if webhook.secret_token:
-            headers['X-Secret-Token'] = webhook.secret_token
-        
-        response = requests.post(
-            webhook.webhook_url,
-            json=payload,
-            headers=headers,
-            timeout=5
+def adjust_total_storage(delta):
+    if delta:
+        db.session.execute(
+            update(GlobalStats)
+            .values(total_storage=GlobalStats.total_storage + delta)
+            .execution_options(synchronize_session=False)
         )
-        
-        webhook.last_triggered = datetime.now(timezone.utc)
-        
-        message = Message.query.filter_by(message_id=message_data['message_id']).first()
-        if message:
-            message.webhook_sent = True
-        
-        db.session.commit()
-        return response.status_code == 200
+
+# Keep-alive connections reused across webhook deliveries to the same host
+webhook_session = requests.Session()
+webhook_adapter = HTTPAdapter(
+    pool_connections=50,
+    pool_maxsize=200,
+    max_retries=Retry(total=2, backoff_factor=0.2)
+)
+webhook_session.mount('http://', webhook_adapter)
+webhook_session.mount('https://', webhook_adapter)
+
+def send_webhook_notification(user_id, message_id, message_data):
+    try:
+        with app.app_context():
+            webhook = UserWebhook.query.filter_by(user_id=user_id, is_active=True).first()
+            if not webhook:
+                return False
+            
+            webhook_id = webhook.id
+            webhook_url = webhook.webhook_url
+            secret_token = webhook.secret_token
+            # Don't hold a pooled connection across the HTTP call
+            db.session.close()
+            
+            payload = {
+                'event': 'new_message',
+                'timestamp': datetime.now(timezone.utc),
+                'data': message_data
+            }
+            
+            headers = {
+                'Content-Type': 'application/json',
+                'User-Agent': 'TelegramBot/1.0'
+            }
+            
+            if secret_token:
+                headers['X-Secret-Token'] = secret_token
+            
+            response = webhook_session.post(
+                webhook_url,
+                data=orjson.dumps(payload, option=ORJSON_OPTIONS),
+                headers=headers,
+                timeout=5
+            )
+            
+            db.session.execute(
+                update(UserWebhook)
+                .where(UserWebhook.id == webhook_id)
+                .values(last_triggered=datetime.now(timezone.utc))
+                .execution_options(synchronize_session=False)
+            )
+            db.session.execute(
+                update(Message)
+                .where(Message.id == message_id)
+                .values(webhook_sent=True)
+                .execution_options(synchronize_session=False)
+            )
+            db.session.commit()
+            return response.status_code == 200
         
     except Exception as e:
-        print(f"Webhook error for user {user_id}: {e}")
+        logger.error("Webhook error for user %s: %s", user_id, e)
         return False
 
 def get_message_preview(message):
@@ -227,27 +581,82 @@ def get_message_preview(message):
         return message.text_content
     return "Message"
 
+def remove_file(file_path):
+    # One unlink instead of exists() + remove(), and no race if another
+    # cleanup pass deleted the file first. Returns whether it was there.
+    try:
+        os.unlink(file_path)
+        return True
+    except FileNotFoundError:
+        return False
+
 def cleanup_old_messages():
     try:
         cutoff_time = datetime.now(timezone.utc) - timedelta(hours=MESSAGE_AUTO_DELETE_HOURS)
-        old_messages = Message.query.filter(Message.sent_at < cutoff_time).all()
-        
-        for message in old_messages:
-            if message.file_path and os.path.exists(message.file_path):
-                os.remove(message.file_path)
-            
-            if message.file_size:
-                sender = User.query.filter_by(user_id=message.sender_id).first()
-                if sender:
-                    sender.storage_used = max(0, sender.storage_used - (message.file_size or 0))
-                    sender.message_count = max(0, sender.message_count - 1)
-            
-            db.session.delete(message)
+        file_paths = [
+            file_path for (file_path,) in db.session.query(Message.file_path).filter(
+                Message.sent_at < cutoff_time,
+                Message.file_path.isnot(None)
+            ).all()
+        ]
         
+        freed = db.session.query(
+            Message.sender_id.label('sender_id'),
+            db.func.sum(Message.file_size).label('total_size'),
+            db.func.count(Message.id).label('file_count')
+        ).filter(
+            Message.sent_at < cutoff_time,
+            Message.file_size > 0
+        ).group_by(Message.sender_id).subquery()
+        
+        db.session.execute(
+            update(User)
+            .where(User.user_id == freed.c.sender_id)
+            .values(
+                storage_used=db.func.max(0, User.storage_used - freed.c.total_size),
+                message_count=db.func.max(0, User.message_count - freed.c.file_count)
+            )
+            .execution_options(synchronize_session=False)
+        )
+        # Sum the released bytes inside the write itself so an overlapping
+        # cleanup that already deleted these rows subtracts nothing
+        released = select(db.func.coalesce(db.func.sum(Message.file_size), 0))\
+            .where(Message.sent_at < cutoff_time).scalar_subquery()
+        db.session.execute(
+            update(GlobalStats)
+            .values(total_storage=GlobalStats.total_storage - released)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.execute(
+            delete(Message)
+            .where(Message.sent_at < cutoff_time)
+            .execution_options(synchronize_session=False)
+        )
         db.session.commit()
+        
+        with ThreadPoolExecutor(max_workers=FILE_REMOVAL_WORKERS) as executor:
+            list(executor.map(remove_file, file_paths))
             
     except Exception as e:
-        print(f"Cleanup error: {e}")
+        db.session.rollback()
+        logger.error("Cleanup error: %s", e)
+
+def remove_stale_uploads():
+    # Spool files are normally unlinked when the request ends; a worker that
+    # dies mid-upload leaves its spool behind in UPLOAD_FOLDER
+    try:
+        cutoff = time.time() - STALE_UPLOAD_AGE
+        with os.scandir(UPLOAD_FOLDER) as entries:
+            for entry in entries:
+                if not entry.name.startswith(UPLOAD_SPOOL_PREFIX):
+                    continue
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        remove_file(entry.path)
+                except FileNotFoundError:
+                    pass  # request finished and unlinked it mid-scan
+    except Exception as e:
+        logger.error("Stale upload cleanup error: %s", e)
 
 def enforce_storage_limits():
     try:
@@ -256,25 +665,33 @@ def enforce_storage_limits():
             files_to_delete = Message.query.filter(Message.file_size.isnot(None))\
                 .order_by(Message.sent_at.asc()).all()
             deleted_size = 0
+            released = 0
+            
+            sender_ids = {message.sender_id for message in files_to_delete}
+            senders = {
+                user.user_id: user
+                for user in User.query.filter(User.user_id.in_(sender_ids)).all()
+            }
             
             for message in files_to_delete:
                 if total_storage - deleted_size <= MAX_TOTAL_STORAGE:
                     break
                     
-                if message.file_path and os.path.exists(message.file_path):
-                    os.remove(message.file_path)
+                if message.file_path and remove_file(message.file_path):
                     deleted_size += message.file_size
                 
-                sender = User.query.filter_by(user_id=message.sender_id).first()
+                sender = senders.get(message.sender_id)
                 if sender:
                     sender.storage_used = max(0, sender.storage_used - message.file_size)
                     sender.message_count = max(0, sender.message_count - 1)
                 
                 db.session.delete(message)
+                released += message.file_size
             
+            adjust_total_storage(-released)
             db.session.commit()
         
-        users = User.query.all()
+        users = User.query.filter(User.storage_used > MAX_USER_STORAGE).all()
         for user in users:
             if user.storage_used > MAX_USER_STORAGE:
                 user_files = Message.query.filter(
@@ -282,38 +699,92 @@ def enforce_storage_limits():
                     Message.file_size.isnot(None)
                 ).order_by(Message.sent_at.asc()).all()
                 deleted_size = 0
+                released = 0
                 
                 for message in user_files:
                     if user.storage_used - deleted_size <= MAX_USER_STORAGE:
                         break
                         
-                    if message.file_path and os.path.exists(message.file_path):
-                        os.remove(message.file_path)
+                    if message.file_path and remove_file(message.file_path):
                         deleted_size += message.file_size
                     
                     user.storage_used -= message.file_size
                     user.message_count -= 1
                     db.session.delete(message)
+                    released += message.file_size
                 
+                adjust_total_storage(-released)
                 db.session.commit()
                 
     except Exception as e:
-        print(f"Storage enforcement error: {e}")
+        db.session.rollback()
+        logger.error("Storage enforcement error: %s", e)
+
+def flush_user_activity():
+    activity = take_pending_activity()
+    if not activity:
+        return
+    
+    try:
+        db.session.execute(
+            update(User)
+            .where(User.id.in_(activity))
+            .values(last_activity=case(activity, value=User.id))
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        restore_pending_activity(activity)
+        logger.error("Activity flush error: %s", e)
 
 # Background tasks
+cleanup_lock = None
+
+def acquire_cleanup_lock():
+    # Retention and eviction run in whichever worker holds this lock; the
+    # file stays open (and locked) for the life of the process
+    global cleanup_lock
+    if cleanup_lock is not None or fcntl is None:
+        return True
+    lock_file = open(CLEANUP_LOCK_FILE, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    cleanup_lock = lock_file
+    return True
+
 def background_cleanup():
+    last_cleanup = 0
     while True:
         try:
-            cleanup_old_messages()
-            enforce_storage_limits()
-            time.sleep(300)
+            with app.app_context():
+                # Activity buffers are per process, so every worker flushes
+                flush_user_activity()
+                if time.time() - last_cleanup >= CLEANUP_INTERVAL:
+                    if acquire_cleanup_lock():
+                        cleanup_old_messages()
+                        enforce_storage_limits()
+                        remove_stale_uploads()
+                    last_cleanup = time.time()
+            time.sleep(ACTIVITY_FLUSH_INTERVAL)
         except Exception as e:
-            print(f"Background cleanup error: {e}")
+            logger.error("Background cleanup error: %s", e)
             time.sleep(60)
 
-# Start background thread
-cleanup_thread = threading.Thread(target=background_cleanup, daemon=True)
-cleanup_thread.start()
+# Webhook deliveries share a bounded pool instead of a thread per message
+webhook_executor = ThreadPoolExecutor(max_workers=WEBHOOK_WORKERS, thread_name_prefix='webhook')
+
+cleanup_thread = None
+
+def start_background_tasks():
+    # Called once the database exists: from __main__, or per gunicorn worker
+    global cleanup_thread
+    if cleanup_thread is None:
+        cleanup_thread = threading.Thread(target=background_cleanup, daemon=True)
+        cleanup_thread.start()
 
 # User Management
 @app.route('/api/users/register', methods=['POST'])
@@ -349,6 +820,7 @@ def register_user():
         user = User(user_id=user_id, username=username, email=email)
         db.session.add(user)
         db.session.commit()
+        cache_user_pk(user.api_key, user.id)
         
         return jsonify({
             'success': True,
@@ -409,8 +881,9 @@ def send_message():
                 reply_to_sender_id = original_message.sender_id
                 reply_to_text = get_message_preview(original_message)
         
-        message_id = secrets.token_hex(16)
-        expires_at = datetime.now(timezone.utc) + timedelta(hours=MESSAGE_AUTO_DELETE_HOURS)
+        message_id, = generate_ids(1)
+        sent_at = datetime.now(timezone.utc)
+        expires_at = sent_at + timedelta(hours=MESSAGE_AUTO_DELETE_HOURS)
         
         message = Message(
             message_id=message_id,
@@ -422,17 +895,16 @@ def send_message():
             sender_id=sender.user_id,
             sender_username=sender.username,
             receiver_id=receiver_id,
+            sent_at=sent_at,
             expires_at=expires_at
         )
         db.session.add(message)
         
         sender.message_count += 1
         db.session.commit()
+        notify_inbox(receiver_id)
         
-        threading.Thread(
-            target=send_webhook_notification,
-            args=(receiver_id, message.to_dict())
-        ).start()
+        webhook_executor.submit(send_webhook_notification, receiver_id, message.id, message.to_dict())
         
         return jsonify({
             'success': True,
@@ -440,7 +912,7 @@ def send_message():
             'data': {
                 'message_id': message_id,
                 'update_id': message.id,
-                'sent_at': message.sent_at.isoformat()
+                'sent_at': sent_at
             }
         })
         
@@ -480,22 +952,6 @@ def send_file():
                 'error': 'Receiver ID is required'
             }), 400
         
-        file.seek(0, 2)
-        file_size = file.tell()
-        file.seek(0)
-        
-        if file_size > 30 * 1024 * 1024:
-            return jsonify({
-                'success': False,
-                'error': 'File size exceeds 30MB limit'
-            }), 400
-        
-        if sender.storage_used + file_size > MAX_USER_STORAGE:
-            return jsonify({
-                'success': False,
-                'error': 'Storage limit exceeded'
-            }), 400
-        
         receiver = User.query.filter_by(user_id=receiver_id, is_active=True).first()
         if not receiver:
             return jsonify({
@@ -514,13 +970,27 @@ def send_file():
         
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
-            file_id = secrets.token_hex(16)
-            message_id = secrets.token_hex(16)
+            file_id, message_id = generate_ids(2)
             unique_filename = f"{file_id}_{filename}"
             file_path = os.path.join(UPLOAD_FOLDER, unique_filename)
-            file.save(file_path)
+            file_size = save_upload(
+                file, file_path, min(MAX_FILE_SIZE, MAX_USER_STORAGE - sender.storage_used)
+            )
             
-            expires_at = datetime.now(timezone.utc) + timedelta(hours=MESSAGE_AUTO_DELETE_HOURS)
+            if file_size > MAX_FILE_SIZE:
+                return jsonify({
+                    'success': False,
+                    'error': 'File size exceeds 30MB limit'
+                }), 400
+            
+            if sender.storage_used + file_size > MAX_USER_STORAGE:
+                return jsonify({
+                    'success': False,
+                    'error': 'Storage limit exceeded'
+                }), 400
+            
+            sent_at = datetime.now(timezone.utc)
+            expires_at = sent_at + timedelta(hours=MESSAGE_AUTO_DELETE_HOURS)
             message = Message(
                 message_id=message_id,
                 message_type='file',
@@ -537,19 +1007,19 @@ def send_file():
                 sender_id=sender.user_id,
                 sender_username=sender.username,
                 receiver_id=receiver_id,
+                sent_at=sent_at,
                 expires_at=expires_at
             )
             db.session.add(message)
             
             sender.storage_used += file_size
             sender.message_count += 1
+            adjust_total_storage(file_size)
             
             db.session.commit()
+            notify_inbox(receiver_id)
             
-            threading.Thread(
-                target=send_webhook_notification,
-                args=(receiver_id, message.to_dict())
-            ).start()
+            webhook_executor.submit(send_webhook_notification, receiver_id, message.id, message.to_dict())
             
             return jsonify({
                 'success': True,
@@ -558,7 +1028,7 @@ def send_file():
                     'message_id': message_id,
                     'file_id': file_id,
                     'update_id': message.id,
-                    'sent_at': message.sent_at.isoformat()
+                    'sent_at': sent_at
                 }
             })
         else:
@@ -580,29 +1050,31 @@ def get_updates():
     try:
         user = request.user
         
-        offset = request.args.get('offset', type=int)
-        limit = request.args.get('limit', POLLING_LIMIT, type=int)
-        timeout = request.args.get('timeout', 0, type=int)
+        offset = int_arg('offset', None, 0, MAX_ROW_ID)
+        limit = int_arg('limit', POLLING_LIMIT, 1, MAX_QUERY_LIMIT)
+        timeout = int_arg('timeout', 0, 0, MAX_POLL_TIMEOUT)
         
-        print(f"User {user.user_id} requesting updates with offset: {offset}")
+        logger.info("User %s requesting updates with offset: %s", user.user_id, offset)
         
-        if offset is None:
-            query = Message.query.filter(Message.receiver_id == user.user_id)
-        else:
-            query = Message.query.filter(
-                Message.receiver_id == user.user_id,
-                Message.id > offset
-            )
+        conditions = [Message.receiver_id == user.user_id]
+        if offset is not None:
+            conditions.append(Message.id > offset)
+        
+        query = select(Message).options(raiseload('*')).where(*conditions)\
+            .order_by(Message.id.asc()).limit(limit)
         
         if timeout > 0:
-            start_time = time.time()
-            while time.time() - start_time < timeout:
-                messages = query.order_by(Message.id.asc()).limit(limit).all()
-                if messages:
-                    break
-                time.sleep(1)
+            deadline = time.time() + timeout
+            inbox = get_inbox(user.user_id)
+            with inbox:
+                messages = db.session.execute(query).scalars().all()
+                while not messages and time.time() < deadline:
+                    # Return the pooled connection while idle
+                    db.session.close()
+                    inbox.wait(min(deadline - time.time(), LONG_POLL_RECHECK))
+                    messages = db.session.execute(query).scalars().all()
         else:
-            messages = query.order_by(Message.id.asc()).limit(limit).all()
+            messages = db.session.execute(query).scalars().all()
         
         updates = []
         max_update_id = offset or 0
@@ -610,12 +1082,18 @@ def get_updates():
         for message in messages:
             updates.append(message.to_dict())
             max_update_id = max(max_update_id, message.id)
-            
-            if not message.is_delivered:
-                message.is_delivered = True
-                message.read_count += 1
         
-        db.session.commit()
+        if messages:
+            db.session.execute(
+                update(Message)
+                .where(
+                    Message.id.in_([message.id for message in messages]),
+                    Message.is_delivered.is_(False)
+                )
+                .values(is_delivered=True, read_count=Message.read_count + 1)
+                .execution_options(synchronize_session=False)
+            )
+            db.session.commit()
         
         next_offset = max_update_id + 1 if updates else (offset or 0)
         
@@ -627,7 +1105,7 @@ def get_updates():
             }
         }
         
-        print(f"Returning {len(updates)} updates, next_offset: {next_offset}")
+        logger.info("Returning %d updates, next_offset: %s", len(updates), next_offset)
         
         return jsonify(response_data)
         
@@ -643,8 +1121,9 @@ def get_chat_history():
     try:
         user = request.user
         other_user_id = request.args.get('user_id')
-        limit = request.args.get('limit', 50, type=int)
-        offset = request.args.get('offset', 0, type=int)
+        limit = int_arg('limit', 50, 1, MAX_QUERY_LIMIT)
+        offset = int_arg('offset', 0, 0, MAX_ROW_ID)
+        before_id = int_arg('before_id', None, 0, MAX_ROW_ID)
         
         if not other_user_id:
             return jsonify({
@@ -652,16 +1131,26 @@ def get_chat_history():
                 'error': 'User ID is required'
             }), 400
         
-        messages = Message.query.filter(
+        query = select(Message).options(raiseload('*')).where(
             ((Message.sender_id == user.user_id) & (Message.receiver_id == other_user_id)) |
             ((Message.sender_id == other_user_id) & (Message.receiver_id == user.user_id))
-        ).order_by(Message.sent_at.desc()).offset(offset).limit(limit).all()
+        ).order_by(Message.id.desc()).limit(limit)
+        
+        # Keyset paging: before_id seeks straight to the page, while the
+        # legacy offset makes SQLite read and discard every skipped row
+        if before_id is not None:
+            query = query.where(Message.id < before_id)
+        elif offset:
+            query = query.offset(offset)
+        
+        messages = db.session.execute(query).scalars().all()
         
         return jsonify({
             'success': True,
             'data': {
                 'messages': [msg.to_dict() for msg in messages],
-                'count': len(messages)
+                'count': len(messages),
+                'next_before_id': messages[-1].id if messages else None
             }
         })
         
@@ -699,8 +1188,24 @@ def download_file(file_id):
         message.read_count += 1
         db.session.commit()
         
-        # ✅ FIXED: Simple send_file without any parameters
-        return send_file(message.file_path)
+        if X_ACCEL_REDIRECT_PREFIX:
+            return Response(
+                mimetype=message.mime_type or 'application/octet-stream',
+                headers={'X-Accel-Redirect': f"{X_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{message.file_name}"}
+            )
+        
+        # Relative paths would be resolved against the app root, not the cwd.
+        # Stored files never change, so repeat downloads can revalidate to a 304.
+        response = flask_send_file(
+            os.path.abspath(message.file_path),
+            conditional=True,
+            etag=True,
+            max_age=DOWNLOAD_MAX_AGE
+        )
+        # Downloads need an API key, so keep them out of shared caches
+        response.cache_control.public = False
+        response.cache_control.private = True
+        return response
         
     except Exception as e:
         return jsonify({
@@ -785,6 +1290,16 @@ def init_db():
     with app.app_context():
         db.create_all()
         
+        # create_all() skips tables that already exist, so add any indexes
+        # missing from databases created before they were declared
+        for index in Message.__table__.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+        
+        if not GlobalStats.query.first():
+            total_storage = db.session.query(db.func.sum(Message.file_size)).scalar()
+            db.session.add(GlobalStats(total_storage=total_storage or 0))
+            db.session.commit()
+        
         admin = User.query.filter_by(user_id='admin').first()
         if not admin:
             admin = User(
@@ -795,16 +1310,18 @@ def init_db():
             )
             db.session.add(admin)
             db.session.commit()
-            print("Admin user created")
+            logger.info("Admin user created")
         
-        print("Database initialized successfully!")
+        logger.info("Database initialized successfully!")
 
 if __name__ == '__main__':
     init_db()
+    start_background_tasks()
     print(f"EXACT Telegram-style API starting on port {PORT}")
     print("=== DOWNLOAD FIXED ===")
     print("✅ send_file() working perfectly")
     print("✅ File download fixed")
     print("======================")
     
-    app.run(host='0.0.0.0', port=PORT, debug=False)
+    # Development only; production runs under gunicorn (see Procfile)
+    app.run(host='0.0.0.0', port=PORT, threaded=True, debug=False)
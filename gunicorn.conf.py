@@ -0,0 +1,21 @@
+# Production server settings: gunicorn -c gunicorn.conf.py api:app
+import os
+import subprocess
+import sys
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 3000)}"
+worker_class = 'gevent'
+workers = 2
+worker_connections = 1000
+timeout = 60
+keepalive = 5
+
+def on_starting(server):
+    # Create tables once before the workers fork. Importing api in the master
+    # itself would load it ahead of the workers' gevent patching.
+    subprocess.run([sys.executable, '-c', 'import api; api.init_db()'], check=True)
+
+def post_worker_init(worker):
+    # Runs after gevent patching; api's file lock leaves cleanup to one worker
+    import api
+    api.start_background_tasks()